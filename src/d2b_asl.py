@@ -1,19 +1,24 @@
 from __future__ import annotations
 
 import argparse
-import csv
 import json
 import logging
+from concurrent.futures import FIRST_EXCEPTION
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 from dataclasses import dataclass
+from functools import cached_property
 from io import StringIO
-from itertools import chain
 from pathlib import Path
 from typing import Any
+from typing import TextIO
 from typing import TYPE_CHECKING
 
 import nibabel as nib
+import numpy as np
 from d2b.hookspecs import hookimpl
 from d2b.utils import first_nii
+from nibabel.openers import ImageOpener
 
 if TYPE_CHECKING:
     from d2b.d2b import D2B, Acquisition
@@ -24,6 +29,10 @@ __version__ = "2.0.1"
 ASL_CONTEXT_DESCRIPTION_PROPERTY = "aslContext"
 BIDS_LABELS = ["cbf", "control", "deltam", "label", "m0scan"]
 ALLOWED_NON_BIDS_LABELS = ["discard"]
+_BIDS_LABEL_SET = frozenset(BIDS_LABELS)
+_NON_BIDS_LABEL_SET = frozenset(ALLOWED_NON_BIDS_LABELS)
+_ALL_VALID_LABELS = _BIDS_LABEL_SET | _NON_BIDS_LABEL_SET
+_WRITE_BUFFER_SIZE = 1 << 16
 
 
 @hookimpl
@@ -45,6 +54,16 @@ def prepare_run_parser(parser: argparse.ArgumentParser):
         "generated by this command. This is the default. NOTE: This being "
         "the default may change in a future release.",
     )
+    parser.add_argument(
+        "--asl-workers",
+        dest="asl_workers",
+        type=int,
+        default=1,
+        help="Number of ASL acquisitions to process concurrently. Each worker "
+        "that discards volumes holds the kept volumes of its acquisition in "
+        "memory (as floating point data), so peak memory grows with this "
+        "number. Defaults to 1 (acquisitions are processed one at a time).",
+    )
 
 
 @hookimpl
@@ -60,7 +79,14 @@ def post_move(
     options: dict[str, Any],
 ):
     include_aslcontext_json: bool = options.get("include_aslcontext_json", False)
-    generate_context_files(out_dir, acquisitions, include_aslcontext_json, d2b.logger)
+    asl_workers: int = options.get("asl_workers", 1)
+    generate_context_files(
+        out_dir,
+        acquisitions,
+        include_aslcontext_json,
+        d2b.logger,
+        max_workers=asl_workers,
+    )
 
 
 def generate_context_files(
@@ -68,25 +94,89 @@ def generate_context_files(
     acquisitions: list[Acquisition],
     include_aslcontext_json: bool,
     logger: logging.Logger,
+    max_workers: int = 1,
 ):
     asl_acquisitions = find_asl_acquisitions(acquisitions)
-    for acq in asl_acquisitions:
-        logger.info(_msg_asl_found(acq))
-        # create the context object
-        aslcontext = Aslcontext.from_acquisition(acq)
-        # find the nii file for this acquisition
-        asl_file = find_asl_file(out_dir, acq)
-        # validate the aslContext
-        aslcontext.validate(asl_file)
-        # write the tsv file
-        aslcontext.write_bids_tsv(out_dir)
-        # write the json file (if asked for)
-        if include_aslcontext_json:
-            aslcontext.write_bids_json(out_dir)
-        # edit the asl data (if necessary)
-        if aslcontext.should_discard_volumes():
-            logger.info(_msg_will_discard_volumes(acq, aslcontext))
-            discard_volumes(asl_file, aslcontext)
+    if not asl_acquisitions:
+        return
+    if max_workers <= 1 or len(asl_acquisitions) == 1:
+        for acq in asl_acquisitions:
+            generate_acquisition_context_files(
+                out_dir,
+                acq,
+                include_aslcontext_json,
+                logger,
+            )
+        return
+    _generate_context_files_concurrently(
+        out_dir,
+        asl_acquisitions,
+        include_aslcontext_json,
+        logger,
+        max_workers,
+    )
+
+
+def _generate_context_files_concurrently(
+    out_dir: Path,
+    asl_acquisitions: list[Acquisition],
+    include_aslcontext_json: bool,
+    logger: logging.Logger,
+    max_workers: int,
+):
+    # acquisitions are independent and the work is I/O-bound (nibabel, gzip, and
+    # numpy release the GIL), so they can be processed concurrently
+    max_workers = min(max_workers, len(asl_acquisitions))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                generate_acquisition_context_files,
+                out_dir,
+                acq,
+                include_aslcontext_json,
+                logger,
+            ): acq
+            for acq in asl_acquisitions
+        }
+        # stop starting new acquisitions (and rewriting their files) after the
+        # first failure, the ones already running are allowed to finish
+        _, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in not_done:
+            future.cancel()
+    first_error: BaseException | None = None
+    for future, acq in futures.items():
+        error = None if future.cancelled() else future.exception()
+        if error is not None:
+            logger.error(_msg_acquisition_failed(acq), exc_info=error)
+            first_error = first_error or error
+    if first_error is not None:
+        # re-raise the first failure (in acquisition order)
+        raise first_error
+
+
+def generate_acquisition_context_files(
+    out_dir: Path,
+    acq: Acquisition,
+    include_aslcontext_json: bool,
+    logger: logging.Logger,
+):
+    logger.info(_msg_asl_found(acq))
+    # create the context object
+    aslcontext = Aslcontext.from_acquisition(acq)
+    # find the nii file for this acquisition
+    asl_file = find_asl_file(out_dir, acq)
+    # validate the aslContext
+    aslcontext.validate(asl_file)
+    # write the tsv file
+    aslcontext.write_bids_tsv(out_dir)
+    # write the json file (if asked for)
+    if include_aslcontext_json:
+        aslcontext.write_bids_json(out_dir)
+    # edit the asl data (if necessary)
+    keep_vols, discards = aslcontext.partition()
+    if discards:
+        logger.info(_msg_will_discard_volumes(acq, discards))
+        discard_volumes(asl_file, aslcontext, keep_vols)
 
 
 def find_asl_acquisitions(acquisitions: list[Acquisition]) -> list[Acquisition]:
@@ -112,63 +202,98 @@ class Aslcontext:
         except KeyError as e:
             raise MissingAslcontextError(acquisition.description.index) from e
 
+    @property
+    def file_root(self) -> str | Path | None:
+        return self._file_root
+
+    @file_root.setter
+    def file_root(self, file_root: str | Path | None):
+        self._file_root = file_root
+        self._tsv_file: Path | None = None
+        self._json_file: Path | None = None
+        if file_root is not None:
+            dst_root = Path(file_root)
+            self._tsv_file = dst_root.parent / f"{dst_root.stem}_aslcontext.tsv"
+            self._json_file = dst_root.parent / f"{dst_root.stem}_aslcontext.json"
+
     @property
     def tsv_file(self) -> Path:
-        if self.file_root is None:
+        if self._tsv_file is None:
             raise TypeError("Cannot write tsv file with NoneType file_root attribute.")
-        dst_root = Path(self.file_root)
-        return dst_root.parent / f"{dst_root.stem}_aslcontext.tsv"
+        return self._tsv_file
 
     @property
     def json_file(self) -> Path:
-        if self.file_root is None:
+        if self._json_file is None:
             raise TypeError("Cannot write json file with NoneType file_root attribute.")
-        dst_root = Path(self.file_root)
-        return dst_root.parent / f"{dst_root.stem}_aslcontext.json"
+        return self._json_file
 
     def validate(self, asl_file: str | Path):
-        img: nib.Nifti1Image = nib.load(asl_file)
-        nvols, nlabels = img.header["dim"][4], len(self.labels)  # type: ignore
-        if nvols != nlabels:
-            raise AslContextConfigurationError(asl_file, nvols, nlabels)
         for label in self.labels:
-            if not (label in BIDS_LABELS or label in ALLOWED_NON_BIDS_LABELS):
+            if label not in _ALL_VALID_LABELS:
                 raise InvalidAslcontextLabelError(label)
+        # only the header is needed, avoid setting up the image and its data
+        header = _read_nifti_header(asl_file)
+        nvols, nlabels = header["dim"][4], len(self.labels)
+        if nvols != nlabels:
+            raise AslContextConfigurationError(asl_file, nvols, nlabels)
 
-    def tagged_labels(self) -> list[TaggedLabel]:
-        return [
-            TaggedLabel(label not in ALLOWED_NON_BIDS_LABELS, label)
+    @cached_property
+    def _tagged_labels(self) -> tuple[TaggedLabel, ...]:
+        # computed once, `labels` must not be changed after construction
+        return tuple(
+            TaggedLabel(label not in _NON_BIDS_LABEL_SET, label)
             for label in self.labels
-        ]
+        )
+
+    def tagged_labels(self) -> list[TaggedLabel]:
+        return list(self._tagged_labels)
+
+    def partition(self) -> tuple[list[int], list[tuple[int, str]]]:
+        """Split volumes into indices to keep and (index, label) pairs to discard."""
+        keep_vols: list[int] = []
+        discards: list[tuple[int, str]] = []
+        for i, t in enumerate(self._tagged_labels):
+            if t.is_bids:
+                keep_vols.append(i)
+            else:
+                discards.append((i, t.label))
+        return keep_vols, discards
 
     def should_discard_volumes(self) -> bool:
-        return any(not t.is_bids for t in self.tagged_labels())
+        return any(not t.is_bids for t in self._tagged_labels)
 
     def tsv(self) -> StringIO:
         f = StringIO()
-        records = [{"volume_type": t.label} for t in self.tagged_labels() if t.is_bids]
-        fieldnames = sorted(set(chain(*(r.keys() for r in records))))
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        for r in records:
-            writer.writerow(r)
+        self._write_tsv(f)
         f.seek(0)
         return f
 
     def json(self) -> StringIO:
         f = StringIO()
-        json.dump(generate_aslcontext_sidecar_content(), f, indent=2)
+        self._write_json(f)
         f.seek(0)
         return f
 
+    def _write_tsv(self, f: TextIO):
+        # single, fixed column; rows use the same line terminator as csv's
+        # default dialect so the output is unchanged
+        rows = ["volume_type"] + [t.label for t in self._tagged_labels if t.is_bids]
+        f.write("".join(f"{row}\r\n" for row in rows))
+
+    def _write_json(self, f: TextIO):
+        f.write(_ASLCONTEXT_SIDECAR_JSON)
+
     def write_tsv(self, filename: str | Path) -> Path:
         out_file = Path(filename)
-        out_file.write_text(self.tsv().read())
+        with open(out_file, "w", buffering=_WRITE_BUFFER_SIZE, newline="") as f:
+            self._write_tsv(f)
         return out_file
 
     def write_json(self, filename: str | Path) -> Path:
         out_file = Path(filename)
-        out_file.write_text(self.json().read())
+        with open(out_file, "w", buffering=_WRITE_BUFFER_SIZE) as f:
+            self._write_json(f)
         return out_file
 
     def write_bids_tsv(self, dataset_dir: str | Path) -> Path:
@@ -180,18 +305,51 @@ class Aslcontext:
         return self.write_json(out_file)
 
 
-def discard_volumes(asl_file: str | Path, aslcontext: Aslcontext):
-    """Discard volumes from the `.nii[.gz]` file associated with this acquisition."""
-    keep_vols = [i for i, tl in enumerate(aslcontext.tagged_labels()) if tl.is_bids]
-    if len(keep_vols) == len(aslcontext.tagged_labels()):
+def discard_volumes(
+    asl_file: str | Path,
+    aslcontext: Aslcontext,
+    keep_vols: list[int] | None = None,
+):
+    """Discard volumes from the `.nii[.gz]` file associated with this acquisition.
+
+    `keep_vols` may be passed when the caller has already partitioned `aslcontext`.
+    """
+    if keep_vols is None:
+        keep_vols, _ = aslcontext.partition()
+    if len(keep_vols) == len(aslcontext.labels):
         # none of the volumes should be discarded, bail early
         return
-    img: nib.Nifti1Image = nib.load(asl_file)
-    data = img.get_data()
-    _data = data[..., keep_vols]
+    # memory-mapping is slow for the few reads done here, and keeping a .gz file
+    # open lets the successive slices below stream forward through the decoder
+    # instead of re-opening (and re-decompressing) the file for every slice
+    is_gz = str(asl_file).endswith(".gz")
+    img: nib.Nifti1Image = nib.load(asl_file, mmap=False, keep_file_open=is_gz)
+    if keep_vols:
+        # only read the kept volumes from disk, the array proxy cannot do fancy
+        # indexing so read each contiguous run of kept volumes as a slice
+        _data = np.concatenate(
+            [img.dataobj[..., start:stop] for start, stop in _runs(keep_vols)],
+            axis=-1,
+        )
+    else:
+        # every volume is discarded, write an empty (x, y, z, 0) image
+        _data = np.asanyarray(img.dataobj[..., :0])
+    # the image constructor copies the header and syncs its shape to `_data`, the
+    # on-disk dtype is kept (nibabel recomputes the scale factors when writing)
     nib.save(img.__class__(_data, img.affine, img.header), asl_file)
 
 
+def _runs(indices: list[int]) -> list[tuple[int, int]]:
+    """Group sorted `indices` into `(start, stop)` pairs of contiguous runs."""
+    runs: list[tuple[int, int]] = []
+    for i in indices:
+        if runs and runs[-1][1] == i:
+            runs[-1] = (runs[-1][0], i + 1)
+        else:
+            runs.append((i, i + 1))
+    return runs
+
+
 def generate_aslcontext_sidecar_content():
     return {
         "volume_type": {
@@ -209,6 +367,25 @@ def generate_aslcontext_sidecar_content():
     }
 
 
+# the sidecar content is static, serialize it once
+_ASLCONTEXT_SIDECAR_JSON = json.dumps(generate_aslcontext_sidecar_content(), indent=2)
+
+
+def _read_nifti_header(filename: str | Path) -> nib.Nifti1Header:
+    """Read only the header of a NIfTI-1 or NIfTI-2 `.nii[.gz]` file."""
+    with ImageOpener(filename) as f:
+        # the leading sizeof_hdr field (in either byte order) tells the formats apart
+        sizeof_hdr = f.read(4)
+        header_class = nib.Nifti1Header
+        if nib.Nifti2Header.sizeof_hdr in (
+            int.from_bytes(sizeof_hdr, "little"),
+            int.from_bytes(sizeof_hdr, "big"),
+        ):
+            header_class = nib.Nifti2Header
+        f.seek(0)
+        return header_class.from_fileobj(f)
+
+
 def find_asl_file(dataset_dir: str | Path, acquisition: Acquisition) -> Path:
     asl_file = first_nii(dataset_dir / acquisition.dst_root)
     if asl_file is None:
@@ -226,13 +403,20 @@ def _msg_asl_found(acquisition: Acquisition):
     )
 
 
-def _msg_will_discard_volumes(acquisition: Acquisition, aslcontext: Aslcontext):
-    non_bids_labels = [
-        (i, t.label) for i, t in enumerate(aslcontext.tagged_labels()) if not t.is_bids
-    ]
-    reason_tpl = "volume at index [{i}] with label [{lab}]"
-    reasons = list(map(lambda x: reason_tpl.format(i=x[0], lab=x[1]), non_bids_labels))
-    reason_string = ",".join(reasons)
+def _msg_acquisition_failed(acquisition: Acquisition):
+    return (
+        "Failed to generate aslcontext files for the acquisition associated with "
+        f"file [{acquisition.src_file}]."
+    )
+
+
+def _msg_will_discard_volumes(
+    acquisition: Acquisition,
+    non_bids_labels: list[tuple[int, str]],
+):
+    reason_string = ",".join(
+        f"volume at index [{i}] with label [{label}]" for i, label in non_bids_labels
+    )
     return (
         f"ASL context for acqusition [{acquisition.dst_root}] has non-BIDS-compliant "
         f"aslContext labels. d2b-asl will remove volumes: {reason_string}"